@@ -12,6 +12,8 @@
 # Based on qmp.py.
 #
 
+import atexit
+import collections
 import errno
 import logging
 import os
@@ -26,6 +28,14 @@ from . import qmp
 
 LOG = logging.getLogger(__name__)
 
+# Shared by all child processes that get no input or whose output is
+# discarded.  subprocess.DEVNULL did not exist before 3.3.
+if hasattr(subprocess, 'DEVNULL'):
+    DEVNULL = subprocess.DEVNULL
+else:
+    DEVNULL = open(os.devnull, 'r+b')
+    atexit.register(DEVNULL.close)
+
 # Mapping host architecture to any additional architectures it can
 # support which often includes its 32 bit cousin.
 ADDITIONAL_ARCHES = {
@@ -52,6 +62,11 @@ CONSOLE_DEV_TYPES = {
     }
 
 
+#: Arguments every machine is launched with, after the monitor chardev
+BASE_ARGS = ('-mon', 'chardev=mon,mode=control',
+             '-display', 'none', '-vga', 'none')
+
+
 class QEMUMachineError(Exception):
     """
     Exception called when an error in QEMUMachine happens.
@@ -121,7 +136,7 @@ class QEMUMachine(object):
         self._binary = binary
         self._args = list(args)     # Force copy args in case we modify them
         self._wrapper = wrapper
-        self._events = []
+        self._events = collections.deque()
         self._iolog = None
         self._socket_scm_helper = socket_scm_helper
         self._qmp = None
@@ -176,9 +191,6 @@ class QEMUMachine(object):
         assert self._qmp.is_scm_available()
         if self._socket_scm_helper is None:
             raise QEMUMachineError("No path to socket_scm_helper set")
-        if not os.path.exists(self._socket_scm_helper):
-            raise QEMUMachineError("%s does not exist" %
-                                   self._socket_scm_helper)
 
         # This did not exist before 3.4, but since then it is
         # mandatory for our purpose
@@ -197,9 +209,15 @@ class QEMUMachine(object):
             assert fd is not None
             fd_param.append(str(fd))
 
-        devnull = open(os.path.devnull, 'rb')
-        proc = subprocess.Popen(fd_param, stdin=devnull, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT, close_fds=False)
+        try:
+            proc = subprocess.Popen(fd_param, stdin=DEVNULL,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, close_fds=False)
+        except OSError as exception:
+            if exception.errno == errno.ENOENT:
+                raise QEMUMachineError("%s does not exist" %
+                                       self._socket_scm_helper)
+            raise
         output = proc.communicate()[0]
         if output:
             LOG.debug(output)
@@ -218,6 +236,37 @@ class QEMUMachine(object):
                 return
             raise
 
+    @staticmethod
+    def _compile_event_match(match):
+        """
+        Turn an event_wait() match template into a predicate on events
+
+        The template is walked once here rather than for every event.
+        """
+        if match is None:
+            return lambda event: True
+
+        checks = []
+        for key, value in match.items():
+            if value is None or isinstance(value, dict):
+                submatch = QEMUMachine._compile_event_match(value)
+            else:
+                submatch = None
+            checks.append((key, value, submatch))
+
+        def event_match(event):
+            for key, value, submatch in checks:
+                if key not in event:
+                    return False
+                if isinstance(event[key], dict):
+                    if submatch is None or not submatch(event[key]):
+                        return False
+                elif event[key] != value:
+                    return False
+            return True
+
+        return event_match
+
     def is_running(self):
         return self._popen is not None and self._popen.poll() is None
 
@@ -243,9 +292,8 @@ class QEMUMachine(object):
                 self._monitor_address[1])
         else:
             moncdev = 'socket,id=mon,path=%s' % self._vm_monitor
-        args = ['-chardev', moncdev,
-                '-mon', 'chardev=mon,mode=control',
-                '-display', 'none', '-vga', 'none']
+        args = ['-chardev', moncdev]
+        args.extend(BASE_ARGS)
         if self._machine is not None:
             args.extend(['-machine', self._machine])
         if self._console_device_type is not None:
@@ -316,13 +364,12 @@ class QEMUMachine(object):
         """
         Launch the VM and establish a QMP connection
         """
-        devnull = open(os.path.devnull, 'rb')
         self._pre_launch()
         self._qemu_full_args = (self._wrapper + [self._binary] +
                                 self._base_args() + self._args)
         LOG.debug('VM launch command: %r', ' '.join(self._qemu_full_args))
         self._popen = subprocess.Popen(self._qemu_full_args,
-                                       stdin=devnull,
+                                       stdin=DEVNULL,
                                        stdout=self._qemu_log_file,
                                        stderr=subprocess.STDOUT,
                                        shell=False,
@@ -342,16 +389,17 @@ class QEMUMachine(object):
         """
         Terminate the VM and clean up
         """
-        if self.is_running():
-            try:
-                self._qmp.cmd('quit')
-                self._qmp.close()
-            except:
-                self._popen.kill()
-            self._popen.wait()
-
-        self._load_io_log()
-        self._post_shutdown()
+        try:
+            if self.is_running():
+                try:
+                    self._qmp.cmd('quit')
+                    self._qmp.close()
+                except:
+                    self._popen.kill()
+                self._popen.wait()
+        finally:
+            self._load_io_log()
+            self._post_shutdown()
 
         exitcode = self.exitcode()
         if exitcode is not None and exitcode < 0:
@@ -368,12 +416,11 @@ class QEMUMachine(object):
         """
         Invoke a QMP command and return the response dict
         """
-        qmp_args = dict()
-        for key, value in args.items():
-            if conv_keys:
-                qmp_args[key.replace('_', '-')] = value
-            else:
-                qmp_args[key] = value
+        if conv_keys:
+            qmp_args = {key.replace('_', '-'): value
+                        for key, value in args.items()}
+        else:
+            qmp_args = dict(args)
 
         return self._qmp.cmd(cmd, args=qmp_args)
 
@@ -395,7 +442,7 @@ class QEMUMachine(object):
         Poll for one queued QMP events and return it
         """
         if len(self._events) > 0:
-            return self._events.pop(0)
+            return self._events.popleft()
         return self._qmp.pull_event(wait=wait)
 
     def get_qmp_events(self, wait=False):
@@ -404,10 +451,30 @@ class QEMUMachine(object):
         """
         events = self._qmp.get_events(wait=wait)
         events.extend(self._events)
-        del self._events[:]
+        self._events.clear()
         self._qmp.clear_events()
         return events
 
+    def get_qmp_events_until(self, names):
+        """
+        Wait for QMP events and yield them one at a time until one whose
+        name is in names arrives
+
+        The events already received along with that one are yielded after
+        it and removed from the queue beforehand, just as if they had all
+        been fetched with get_qmp_events(); a caller that stops at the
+        matching event drops them.
+        """
+        while True:
+            event = self.get_qmp_event(wait=True)
+            if event['event'] in names:
+                rest = self.get_qmp_events()
+                yield event
+                for event in rest:
+                    yield event
+                return
+            yield event
+
     def event_wait(self, name, timeout=60.0, match=None):
         """
         Wait for specified timeout on named event in QMP; optionally filter
@@ -417,33 +484,20 @@ class QEMUMachine(object):
         branch processing on match's value None
            {"foo": {"bar": 1}} matches {"foo": None}
            {"foo": {"bar": 1}} does not matches {"foo": {"baz": None}}
+           {"foo": {"bar": 1}} does not matches {"foo": 1}
         """
-        def event_match(event, match=None):
-            if match is None:
-                return True
-
-            for key in match:
-                if key in event:
-                    if isinstance(event[key], dict):
-                        if not event_match(event[key], match[key]):
-                            return False
-                    elif event[key] != match[key]:
-                        return False
-                else:
-                    return False
-
-            return True
+        event_match = self._compile_event_match(match)
 
         # Search cached events
-        for event in self._events:
-            if (event['event'] == name) and event_match(event, match):
-                self._events.remove(event)
+        for i, event in enumerate(self._events):
+            if (event['event'] == name) and event_match(event):
+                del self._events[i]
                 return event
 
         # Poll for new events
         while True:
             event = self._qmp.pull_event(wait=timeout)
-            if (event['event'] == name) and event_match(event, match):
+            if (event['event'] == name) and event_match(event):
                 return event
             self._events.append(event)
 
@@ -108,8 +108,10 @@ class QEMUQtestMachine(QEMUMachine):
         self._qtest.accept()
 
     def _post_shutdown(self):
-        super(QEMUQtestMachine, self)._post_shutdown()
-        self._remove_if_exists(self._qtest_path)
+        try:
+            super(QEMUQtestMachine, self)._post_shutdown()
+        finally:
+            self._remove_if_exists(self._qtest_path)
 
     def qtest(self, cmd):
         '''Send a qtest command to guest'''
@@ -30,10 +30,12 @@ import signal
 import logging
 import atexit
 import io
+import multiprocessing
+import time
 from collections import OrderedDict
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'python'))
-from qemu import qtest
+from qemu import qtest, DEVNULL
 
 
 # This will not work if arguments contain spaces but is necessary if we
@@ -70,12 +72,60 @@ luks_default_key_secret_opt = 'key-secret=keysec0'
 
 def qemu_img(*args):
     '''Run qemu-img and return the exit code'''
-    devnull = open('/dev/null', 'r+')
-    exitcode = subprocess.call(qemu_img_args + list(args), stdin=devnull, stdout=devnull)
+    exitcode = subprocess.call(qemu_img_args + list(args), stdin=DEVNULL, stdout=DEVNULL)
     if exitcode < 0:
         sys.stderr.write('qemu-img received signal %i: %s\n' % (-exitcode, ' '.join(qemu_img_args + list(args))))
     return exitcode
 
+def qemu_img_many(*cmds):
+    '''Run independent qemu-img commands in parallel and return the exit
+       code of the first one that fails (0 if all of them succeed)
+
+    Each command is a list of qemu-img arguments, e.g.:
+
+    qemu_img_many(['create', '-f', imgfmt, img_a, '1M'],
+                  ['create', '-f', imgfmt, img_b, '1M'])
+
+    The commands must not depend on each other; at most one command per
+    CPU is run at a time.
+    '''
+    try:
+        max_jobs = multiprocessing.cpu_count()
+    except NotImplementedError:
+        max_jobs = 1
+    running = []
+    exitcodes = [0] * len(cmds)
+
+    def reap():
+        # Poll rather than os.wait() so that other children of the test,
+        # like a running VM, are left alone
+        while True:
+            for i, (index, args, subp) in enumerate(running):
+                exitcode = subp.poll()
+                if exitcode is not None:
+                    del running[i]
+                    if exitcode < 0:
+                        sys.stderr.write('qemu-img received signal %i: %s\n' % (-exitcode, ' '.join(args)))
+                    exitcodes[index] = exitcode
+                    return
+            time.sleep(0.01)
+
+    try:
+        for index, cmd in enumerate(cmds):
+            if len(running) >= max_jobs:
+                reap()
+            args = qemu_img_args + list(cmd)
+            running.append((index, args,
+                            subprocess.Popen(args, stdin=DEVNULL, stdout=DEVNULL)))
+    finally:
+        while running:
+            reap()
+
+    for exitcode in exitcodes:
+        if exitcode != 0:
+            return exitcode
+    return 0
+
 def ordered_qmp(qmsg, conv_keys=True):
     # Dictionaries are not ordered prior to 3.6, therefore:
     if isinstance(qmsg, list):
@@ -121,10 +171,10 @@ def qemu_img_pipe(*args):
                             stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT,
                             universal_newlines=True)
-    exitcode = subp.wait()
-    if exitcode < 0:
-        sys.stderr.write('qemu-img received signal %i: %s\n' % (-exitcode, ' '.join(qemu_img_args + list(args))))
-    return subp.communicate()[0]
+    output = subp.communicate()[0]
+    if subp.returncode < 0:
+        sys.stderr.write('qemu-img received signal %i: %s\n' % (-subp.returncode, ' '.join(qemu_img_args + list(args))))
+    return output
 
 def img_info_log(filename, filter_path=None, imgopts=False, extra_args=[]):
     args = [ 'info' ]
@@ -146,15 +196,15 @@ def qemu_io(*args):
     subp = subprocess.Popen(args, stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT,
                             universal_newlines=True)
-    exitcode = subp.wait()
-    if exitcode < 0:
-        sys.stderr.write('qemu-io received signal %i: %s\n' % (-exitcode, ' '.join(args)))
-    return subp.communicate()[0]
+    output = subp.communicate()[0]
+    if subp.returncode < 0:
+        sys.stderr.write('qemu-io received signal %i: %s\n' % (-subp.returncode, ' '.join(args)))
+    return output
 
 def qemu_io_silent(*args):
     '''Run qemu-io and return the exit code, suppressing stdout'''
     args = qemu_io_args + list(args)
-    exitcode = subprocess.call(args, stdout=open('/dev/null', 'w'))
+    exitcode = subprocess.call(args, stdout=DEVNULL)
     if exitcode < 0:
         sys.stderr.write('qemu-io received signal %i: %s\n' %
                          (-exitcode, ' '.join(args)))
@@ -223,15 +273,30 @@ def compare_images(img1, img2, fmt1=imgfmt, fmt2=imgfmt):
     return qemu_img('compare', '-f', fmt1,
                     '-F', fmt2, img1, img2) == 0
 
+sector_marker = struct.Struct('>l504xl')
+
 def create_image(name, size):
     '''Create a fully-allocated raw image with sector markers'''
-    file = open(name, 'wb')
-    i = 0
-    while i < size:
-        sector = struct.pack('>l504xl', i // 512, i // 512)
-        file.write(sector)
-        i = i + 512
-    file.close()
+    sectors = (size + 511) // 512
+    # Write in slabs of 4 MB rather than one sector at a time
+    buf = bytearray(sector_marker.size * min(sectors, 8192))
+    with open(name, 'wb') as file:
+        # This did not exist before 3.3; it lets the file system allocate
+        # the whole image at once instead of extending it slab by slab
+        if hasattr(os, 'posix_fallocate') and sectors:
+            try:
+                os.posix_fallocate(file.fileno(), 0,
+                                   sectors * sector_marker.size)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        i = 0
+        while i < sectors:
+            n = min(sectors - i, 8192)
+            for offset in range(0, n * sector_marker.size, sector_marker.size):
+                sector_marker.pack_into(buf, offset, i, i)
+                i += 1
+            file.write(memoryview(buf)[:n * sector_marker.size])
 
 def image_size(img):
     '''Return image's virtual size'''
@@ -564,22 +629,35 @@ class VM(qtest.QEMUQtestMachine):
 
 index_re = re.compile(r'([^\[]+)\[([^\]]+)\]')
 
-class QMPTestCase(unittest.TestCase):
-    '''Abstract base class for QMP test cases'''
+# Tests assert on the same few paths over and over, so only parse each once
+dictpath_cache = {}
 
-    def dictpath(self, d, path):
-        '''Traverse a path in a nested dict'''
+def parse_dictpath(path):
+    '''Split a dictpath into a tuple of (key, list index or None) pairs'''
+    components = dictpath_cache.get(path)
+    if components is None:
+        components = []
         for component in path.split('/'):
             m = index_re.match(component)
             if m:
                 component, idx = m.groups()
-                idx = int(idx)
+                components.append((component, int(idx)))
+            else:
+                components.append((component, None))
+        components = dictpath_cache[path] = tuple(components)
+    return components
+
+class QMPTestCase(unittest.TestCase):
+    '''Abstract base class for QMP test cases'''
 
+    def dictpath(self, d, path):
+        '''Traverse a path in a nested dict'''
+        for component, idx in parse_dictpath(path):
             if not isinstance(d, dict) or component not in d:
                 self.fail('failed path traversal for "%s" in "%s"' % (path, str(d)))
             d = d[component]
 
-            if m:
+            if idx is not None:
                 if not isinstance(d, list):
                     self.fail('path component "%s" in "%s" is not a list in "%s"' % (component, path, str(d)))
                 try:
@@ -633,35 +711,31 @@ class QMPTestCase(unittest.TestCase):
         if resume:
             self.vm.resume_drive(drive)
 
-        cancelled = False
         result = None
-        while not cancelled:
-            for event in self.vm.get_qmp_events(wait=True):
-                if event['event'] == 'BLOCK_JOB_COMPLETED' or \
-                   event['event'] == 'BLOCK_JOB_CANCELLED':
-                    self.assert_qmp(event, 'data/device', drive)
-                    result = event
-                    cancelled = True
-                elif event['event'] == 'JOB_STATUS_CHANGE':
-                    self.assert_qmp(event, 'data/id', drive)
-
+        for event in self.vm.get_qmp_events_until(('BLOCK_JOB_COMPLETED',
+                                                   'BLOCK_JOB_CANCELLED')):
+            if event['event'] == 'BLOCK_JOB_COMPLETED' or \
+               event['event'] == 'BLOCK_JOB_CANCELLED':
+                self.assert_qmp(event, 'data/device', drive)
+                result = event
+            elif event['event'] == 'JOB_STATUS_CHANGE':
+                self.assert_qmp(event, 'data/id', drive)
 
         self.assert_no_active_block_jobs()
         return result
 
     def wait_until_completed(self, drive='drive0', check_offset=True):
         '''Wait for a block job to finish, returning the event'''
-        while True:
-            for event in self.vm.get_qmp_events(wait=True):
-                if event['event'] == 'BLOCK_JOB_COMPLETED':
-                    self.assert_qmp(event, 'data/device', drive)
-                    self.assert_qmp_absent(event, 'data/error')
-                    if check_offset:
-                        self.assert_qmp(event, 'data/offset', event['data']['len'])
-                    self.assert_no_active_block_jobs()
-                    return event
-                elif event['event'] == 'JOB_STATUS_CHANGE':
-                    self.assert_qmp(event, 'data/id', drive)
+        for event in self.vm.get_qmp_events_until(('BLOCK_JOB_COMPLETED',)):
+            if event['event'] == 'BLOCK_JOB_COMPLETED':
+                self.assert_qmp(event, 'data/device', drive)
+                self.assert_qmp_absent(event, 'data/error')
+                if check_offset:
+                    self.assert_qmp(event, 'data/offset', event['data']['len'])
+                self.assert_no_active_block_jobs()
+                return event
+            elif event['event'] == 'JOB_STATUS_CHANGE':
+                self.assert_qmp(event, 'data/id', drive)
 
     def wait_ready(self, drive='drive0'):
         '''Wait until a block job BLOCK_JOB_READY event'''
@@ -771,11 +845,11 @@ def qemu_pipe(*args):
     subp = subprocess.Popen(args, stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT,
                             universal_newlines=True)
-    exitcode = subp.wait()
-    if exitcode < 0:
-        sys.stderr.write('qemu received signal %i: %s\n' % (-exitcode,
+    output = subp.communicate()[0]
+    if subp.returncode < 0:
+        sys.stderr.write('qemu received signal %i: %s\n' % (-subp.returncode,
                          ' '.join(args)))
-    return subp.communicate()[0]
+    return output
 
 def supported_formats(read_only=False):
     '''Set 'read_only' to True to check ro-whitelist
@@ -799,6 +873,8 @@ def skip_if_unsupported(required_formats=[], read_only=False):
         return func_wrapper
     return skip_test_decorator
 
+test_time_re = re.compile(r'Ran (\d+) tests? in [\d.]+s')
+
 def main(supported_fmts=[], supported_oses=['linux'], supported_cache_modes=[],
          unsupported_fmts=[]):
     '''Run tests'''
@@ -844,4 +920,4 @@ def main(supported_fmts=[], supported_oses=['linux'], supported_cache_modes=[],
         unittest.main(testRunner=MyTestRunner)
     finally:
         if not debug:
-            sys.stderr.write(re.sub(r'Ran (\d+) tests? in [\d.]+s', r'Ran \1 tests', output.getvalue()))
+            sys.stderr.write(test_time_re.sub(r'Ran \1 tests', output.getvalue()))